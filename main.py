@@ -1,39 +1,139 @@
+import asyncio
+import logging
 import os
-import random
+import re
+import secrets
 from datetime import datetime, timezone
-from typing import Optional
+from functools import lru_cache
+from typing import Literal, Optional
 
-from fastapi import FastAPI, HTTPException, Request
+import orjson
+from bson import ObjectId
+from cachetools import TTLCache
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, EmailStr
+from fastapi.responses import ORJSONResponse, Response
+from pydantic import BaseModel, EmailStr, ValidationError
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
 
 from database import db, create_document, get_documents
 from schemas import Contact, Event, Rsvp, Smsmessage
 
+UTC = timezone.utc
+
+logger = logging.getLogger(__name__)
+
 # Optional Twilio; only used if credentials exist
 TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID")
 TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
 TWILIO_FROM_NUMBER = os.getenv("TWILIO_FROM_NUMBER")
 
+# Shared keep-alive client against the Twilio REST API so sends reuse the TLS session
 twilio_client = None
 if TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN:
     try:
-        from twilio.rest import Client  # type: ignore
-        twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+        import httpx
+        twilio_client = httpx.AsyncClient(
+            base_url="https://api.twilio.com",
+            auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN),
+            http2=True,
+            timeout=10.0,
+        )
     except Exception:
         twilio_client = None
 
-app = FastAPI(title="Anomaly Events Backend")
+# Encoded /events payload; events change rarely, so a short TTL bounds staleness
+_events_cache = TTLCache(maxsize=1, ttl=30)
+# Bumped on every event write; a read only caches its body if no write happened meanwhile
+_events_generation = 0
+
+# States whose contacts are segmented as "local"
+_LOCAL_STATES = frozenset({"CA", "NY", "NV", "WA", "OR", "TX", "FL"})
+
+app = FastAPI(title="Anomaly Events Backend", default_response_class=ORJSONResponse)
+
+# Comma-separated list of allowed browser origins; unset keeps the permissive "*" default
+ALLOWED_ORIGINS = frozenset(o.strip() for o in (os.getenv("CORS_ALLOWED_ORIGINS") or "").split(",") if o.strip())
+
+
+class ExactOriginCORSMiddleware(CORSMiddleware):
+    """CORSMiddleware that checks explicit origins with a single frozenset lookup."""
+
+    def __init__(self, app, allow_origins=(), **kwargs):
+        super().__init__(app, allow_origins=allow_origins, **kwargs)
+        self._origin_set = frozenset(allow_origins)
+
+    def is_allowed_origin(self, origin: str) -> bool:
+        if self.allow_all_origins or origin in self._origin_set:
+            return True
+        return self.allow_origin_regex is not None and self.allow_origin_regex.fullmatch(origin) is not None
+
 
 app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
+    ExactOriginCORSMiddleware,
+    allow_origins=list(ALLOWED_ORIGINS) or ["*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
 
+@app.on_event("startup")
+async def warm_db_pool():
+    """Open pooled connections up front so the first requests skip the handshake."""
+    if db is None:
+        return
+    try:
+        await asyncio.gather(*[db.command("ping") for _ in range(10)])
+    except PyMongoError as e:
+        # Best effort; connections are opened lazily if the server is not reachable yet
+        logger.warning("Could not warm database connection pool: %s", e)
+
+
+async def _create_index(collection: str, keys, **options) -> None:
+    try:
+        await db[collection].create_index(keys, background=True, **options)
+    except PyMongoError as e:
+        # Unreachable server or pre-existing duplicates; the app keeps serving without this index
+        logger.warning("Could not create index %s on %s: %s", keys, collection, e)
+
+
+async def _build_indexes() -> None:
+    await asyncio.gather(
+        _create_index("contact", "phone", unique=True),
+        _create_index("contact", [("status", 1), ("brand_queue", 1)]),
+        _create_index("rsvp", [("contact_id", 1), ("event_id", 1)], unique=True),
+        # Unique only among sent messages; queued/failed logs carry no provider sid
+        _create_index(
+            "smsmessage",
+            "provider_message_sid",
+            unique=True,
+            partialFilterExpression={"provider_message_sid": {"$type": "string"}},
+        ),
+    )
+
+
+# Held so the index build task is not garbage-collected while it runs
+_index_task: Optional[asyncio.Task] = None
+
+
+@app.on_event("startup")
+async def ensure_indexes():
+    """Declare indexes backing the hot lookups so queries avoid collection scans."""
+    global _index_task
+    if db is None:
+        return
+    # createIndexes only replies once a build finishes, so run the builds off the startup path
+    _index_task = asyncio.create_task(_build_indexes())
+
+
+@app.on_event("shutdown")
+async def close_twilio_client():
+    if twilio_client is not None:
+        await twilio_client.aclose()
+
+
 # Utility helpers
 
 def _collection(name: str):
@@ -42,9 +142,39 @@ def _collection(name: str):
     return db[name]
 
 
+_is_object_id = re.compile(r"[0-9a-fA-F]{24}").fullmatch
+
+
+# Verification codes are drawn from a pre-filled CSPRNG buffer, 3 bytes per candidate
+_CODE_BUF_SIZE = 4095
+_CODE_LIMIT = (1 << 24) // 900000 * 900000  # reject above this to keep codes uniform
+_code_buf = b""
+_code_idx = 0
+
+
+def _code() -> str:
+    """Generate a 6-digit verification code from the OS CSPRNG."""
+    global _code_buf, _code_idx
+    while True:
+        if _code_idx + 3 > len(_code_buf):
+            _code_buf = secrets.token_bytes(_CODE_BUF_SIZE)
+            _code_idx = 0
+        value = int.from_bytes(_code_buf[_code_idx:_code_idx + 3], "big")
+        _code_idx += 3
+        if value < _CODE_LIMIT:
+            return f"{value % 900000 + 100000:06d}"
+
+
+_NON_DIGIT = re.compile(r"\D+")
+
+
+@lru_cache(maxsize=4096)
 def _normalize_phone(phone: str) -> str:
+    # Fast path: already E.164, nothing to strip
+    if len(phone) >= 12 and phone[0] == "+" and phone.isascii() and phone[1:].isdigit():
+        return phone
     # Basic normalization to keep digits and ensure + prefix if provided
-    digits = "".join(ch for ch in phone if ch.isdigit())
+    digits = _NON_DIGIT.sub("", phone)
     if phone.strip().startswith("+"):
         return "+" + digits
     # Default to US if 10 digits
@@ -53,25 +183,60 @@ def _normalize_phone(phone: str) -> str:
     return "+" + digits if not digits.startswith("+") else digits
 
 
-def _send_sms(to: str, body: str, purpose: str) -> Optional[str]:
+# SMS throttling: per-phone debounce plus a system-wide cap of ~17 sends/second (Twilio A2P limit)
+SMS_DEBOUNCE_SECONDS = 2.0
+SMS_SENDS_PER_SECOND = 17
+# Status callbacks kept per message; older entries are trimmed on each webhook update
+SMS_LOG_HISTORY = 50
+# Phones with a verification SMS queued inside the debounce window; entries expire on their own
+_recently_sent = TTLCache(maxsize=100_000, ttl=SMS_DEBOUNCE_SECONDS)
+_sms_slots = asyncio.Semaphore(SMS_SENDS_PER_SECOND)
+
+
+def _sms_debounced(phone: str) -> bool:
+    """True if a verification SMS was queued for this phone within the debounce window."""
+    return phone in _recently_sent
+
+
+def _queue_verification_sms(background: BackgroundTasks, phone: str, code: str) -> None:
+    _recently_sent[phone] = True
+    background.add_task(_send_sms, phone, f"Anomaly verification code: {code}", "verify")
+
+
+async def _send_sms(to: str, body: str, purpose: str) -> Optional[str]:
     """Send SMS via Twilio if configured. Returns provider message sid or None."""
     sid = None
     try:
         to_norm = _normalize_phone(to)
         if twilio_client and TWILIO_FROM_NUMBER:
-            msg = twilio_client.messages.create(
-                to=to_norm,
-                from_=TWILIO_FROM_NUMBER,
-                body=body,
-                status_callback=os.getenv("TWILIO_STATUS_WEBHOOK") or None,
+            # Each slot is held for a full second after acquisition, which bounds the send rate
+            await _sms_slots.acquire()
+            asyncio.get_running_loop().call_later(1.0, _sms_slots.release)
+            data = {"To": to_norm, "From": TWILIO_FROM_NUMBER, "Body": body}
+            status_callback = os.getenv("TWILIO_STATUS_WEBHOOK")
+            if status_callback:
+                data["StatusCallback"] = status_callback
+            resp = await twilio_client.post(f"/2010-04-01/Accounts/{TWILIO_ACCOUNT_SID}/Messages.json", data=data)
+            resp.raise_for_status()
+            sid = resp.json()["sid"]
+            # Upsert on the sid: Twilio's status callback may already have created this record
+            message = Smsmessage(to=to_norm, body=body, purpose=purpose, status="sent", provider_message_sid=sid)
+            now = datetime.now(UTC)
+            on_insert = message.model_dump(exclude={"to", "body", "purpose", "provider_message_sid"})
+            on_insert["created_at"] = now
+            await _collection("smsmessage").update_one(
+                {"provider_message_sid": message.provider_message_sid},
+                {
+                    "$set": {"to": message.to, "body": message.body, "purpose": message.purpose, "updated_at": now},
+                    "$setOnInsert": on_insert,
+                },
+                upsert=True,
             )
-            sid = msg.sid
-            create_document("smsmessage", Smsmessage(to=to_norm, body=body, purpose=purpose, status="sent", provider_message_sid=sid))
         else:
             # Fallback: log only
-            create_document("smsmessage", Smsmessage(to=to_norm, body=body, purpose=purpose, status="queued"))
+            await create_document("smsmessage", Smsmessage(to=to_norm, body=body, purpose=purpose, status="queued"))
     except Exception as e:
-        create_document("smsmessage", Smsmessage(to=to_norm, body=body, purpose=purpose, status="failed", error_message=str(e)))
+        await create_document("smsmessage", Smsmessage(to=to_norm, body=body, purpose=purpose, status="failed", error_message=str(e)))
     return sid
 
 
@@ -108,7 +273,7 @@ class EventCreateRequest(BaseModel):
 class RsvpRequest(BaseModel):
     contact_id: str
     event_id: str
-    status: str  # yes | not_this_time | no_response
+    status: Literal["yes", "not_this_time", "no_response"]
 
 
 # Routes
@@ -118,7 +283,7 @@ def root():
 
 
 @app.get("/test")
-def test_database():
+async def test_database():
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -131,7 +296,7 @@ def test_database():
         if db is not None:
             response["database"] = "✅ Available"
             response["connection_status"] = "Connected"
-            response["collections"] = db.list_collection_names()[:10]
+            response["collections"] = (await db.list_collection_names())[:10]
         else:
             response["database"] = "❌ Not Available"
     except Exception as e:
@@ -141,83 +306,110 @@ def test_database():
 
 # Contact registration and verification
 @app.post("/contacts/register")
-def register_contact(payload: RegistrationRequest):
+async def register_contact(payload: RegistrationRequest, background: BackgroundTasks):
     phone = _normalize_phone(payload.phone)
-    # Check if exists
-    existing = _collection("contact").find_one({"phone": phone})
-    if existing:
-        # Allow re-send verification if not verified
-        code = str(random.randint(100000, 999999))
-        _collection("contact").update_one({"_id": existing["_id"]}, {"$set": {"verification_code": code, "updated_at": datetime.now(timezone.utc)}})
-        _send_sms(phone, f"Anomaly verification code: {code}", purpose="verify")
-        return {"id": str(existing["_id"]), "phone": phone, "message": "Contact exists, verification re-sent"}
-
-    # Create new contact
-    code = str(random.randint(100000, 999999))
-    segment = "local" if (payload.state or "").strip().upper() in {"CA", "NY", "NV", "WA", "OR", "TX", "FL"} else "out_of_state"
-    contact = Contact(
-        name=payload.name,
-        phone=phone,
-        email=payload.email,
-        headshot_url=payload.headshot_url,
-        city=payload.city,
-        state=payload.state,
-        brand_queue=(payload.brand_queue or "anomaly").lower(),
-        segment=segment,
-        status="pending",
-        phone_verified=False,
-        referred_by=payload.referred_by,
-        verification_code=code,
-    )
-    contact_id = create_document("contact", contact)
-    _send_sms(phone, f"Anomaly verification code: {code}", purpose="verify")
-    return {"id": contact_id, "phone": phone, "message": "Registration received. Verification sent."}
+    code = _code()
+    segment = "local" if (payload.state or "").strip().upper() in _LOCAL_STATES else "out_of_state"
+    now = datetime.now(UTC)
+    to_set = {"updated_at": now}
+    # Within the debounce window keep the code that was just sent instead of rotating it
+    debounced = _sms_debounced(phone)
+    if not debounced:
+        to_set["verification_code"] = code
+    try:
+        contact = Contact(
+            name=payload.name,
+            phone=phone,
+            email=payload.email,
+            headshot_url=payload.headshot_url,
+            city=payload.city,
+            state=payload.state,
+            brand_queue=(payload.brand_queue or "anomaly").lower(),
+            segment=segment,
+            status="pending",
+            phone_verified=False,
+            referred_by=payload.referred_by,
+            verification_code=code,
+        )
+    except ValidationError as e:
+        # Profile fields only matter for new contacts; an existing one still gets its code refreshed
+        doc = await _collection("contact").find_one_and_update(
+            {"phone": phone}, {"$set": to_set}, projection={"_id": 1}
+        )
+        if not doc:
+            raise HTTPException(422, e.errors(include_url=False, include_context=False))
+        new_id = None
+    else:
+        new_id = ObjectId()
+        on_insert = contact.model_dump(exclude={"phone", *to_set})
+        on_insert.update({"_id": new_id, "created_at": now})
+        # Single round-trip: refresh the code on an existing contact or create a new one
+        doc = await _collection("contact").find_one_and_update(
+            {"phone": phone},
+            {"$set": to_set, "$setOnInsert": on_insert},
+            projection={"_id": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+    if doc["_id"] == new_id:
+        _queue_verification_sms(background, phone, code)
+        return {"id": str(new_id), "phone": phone, "message": "Registration received. Verification sent."}
+    if debounced:
+        return {"id": str(doc["_id"]), "phone": phone, "message": "Contact exists, verification already sent"}
+    # Allow re-send verification if not verified
+    _queue_verification_sms(background, phone, code)
+    return {"id": str(doc["_id"]), "phone": phone, "message": "Contact exists, verification re-sent"}
 
 
 @app.post("/contacts/verify/send")
-def send_verification(payload: VerifySendRequest):
+async def send_verification(payload: VerifySendRequest, background: BackgroundTasks):
     phone = _normalize_phone(payload.phone)
-    contact = _collection("contact").find_one({"phone": phone})
+    if _sms_debounced(phone):
+        # A code was just sent; let the client use it rather than sending another
+        if not await _collection("contact").find_one({"phone": phone}, {"_id": 1}):
+            raise HTTPException(404, "Contact not found")
+        return {"message": "Verification sent"}
+    code = _code()
+    contact = await _collection("contact").find_one_and_update(
+        {"phone": phone},
+        {"$set": {"verification_code": code, "updated_at": datetime.now(UTC)}},
+        projection={"_id": 1},
+    )
     if not contact:
         raise HTTPException(404, "Contact not found")
-    code = str(random.randint(100000, 999999))
-    _collection("contact").update_one({"_id": contact["_id"]}, {"$set": {"verification_code": code, "updated_at": datetime.now(timezone.utc)}})
-    _send_sms(phone, f"Anomaly verification code: {code}", purpose="verify")
+    _queue_verification_sms(background, phone, code)
     return {"message": "Verification sent"}
 
 
 @app.post("/contacts/verify/confirm")
-def confirm_verification(payload: VerifyConfirmRequest):
+async def confirm_verification(payload: VerifyConfirmRequest):
     phone = _normalize_phone(payload.phone)
-    contact = _collection("contact").find_one({"phone": phone})
+    contact = await _collection("contact").find_one_and_update(
+        {"phone": phone, "verification_code": payload.code},
+        {"$set": {"phone_verified": True, "verification_code": None, "updated_at": datetime.now(UTC)}},
+        projection={"_id": 1},
+    )
     if not contact:
-        raise HTTPException(404, "Contact not found")
-    if payload.code != contact.get("verification_code"):
+        # Only the failure path pays for a second lookup to pick the right error
+        if not await _collection("contact").find_one({"phone": phone}, {"_id": 1}):
+            raise HTTPException(404, "Contact not found")
         raise HTTPException(400, "Invalid verification code")
-
-    _collection("contact").update_one(
-        {"_id": contact["_id"]},
-        {"$set": {"phone_verified": True, "verification_code": None, "updated_at": datetime.now(timezone.utc)}}
-    )
     return {"message": "Phone verified", "contact_id": str(contact["_id"])}
 
 
 @app.get("/contacts")
-def list_contacts(status: Optional[str] = None, brand: Optional[str] = None):
+async def list_contacts(status: Optional[str] = None, brand: Optional[str] = None):
     filt = {}
     if status:
         filt["status"] = status
     if brand:
         filt["brand_queue"] = brand
-    docs = get_documents("contact", filt)
-    for d in docs:
-        d["_id"] = str(d["_id"])
-        d.pop("verification_code", None)
-    return docs
+    return await get_documents("contact", filt, exclude_fields=["verification_code"])
 
 
 @app.post("/events")
-def create_event(payload: EventCreateRequest):
+async def create_event(payload: EventCreateRequest):
+    global _events_generation
     event = Event(
         name=payload.name,
         date=payload.date,
@@ -227,40 +419,51 @@ def create_event(payload: EventCreateRequest):
         ticket_price=payload.ticket_price or 30.0,
         status="scheduled",
     )
-    event_id = create_document("event", event)
+    event_id = await create_document("event", event)
+    _events_generation += 1
+    _events_cache.clear()
     return {"id": event_id}
 
 
 @app.get("/events")
-def list_events():
-    docs = get_documents("event")
-    for d in docs:
-        d["_id"] = str(d["_id"])
-    return docs
+async def list_events():
+    body = _events_cache.get("all")
+    if body is None:
+        generation = _events_generation
+        body = orjson.dumps(await get_documents("event"))
+        if generation == _events_generation:
+            _events_cache["all"] = body
+    return Response(content=body, media_type="application/json")
 
 
 @app.post("/rsvps")
-def upsert_rsvp(payload: RsvpRequest):
-    from bson import ObjectId  # type: ignore
-    try:
-        contact_id = ObjectId(payload.contact_id)
-        event_id = ObjectId(payload.event_id)
-    except Exception:
+async def upsert_rsvp(payload: RsvpRequest):
+    if not (_is_object_id(payload.contact_id) and _is_object_id(payload.event_id)):
         raise HTTPException(400, "Invalid IDs")
+    contact_id = ObjectId(payload.contact_id)
+    event_id = ObjectId(payload.event_id)
 
-    if not _collection("contact").find_one({"_id": contact_id}):
+    contact, event = await asyncio.gather(
+        _collection("contact").find_one({"_id": contact_id}, {"_id": 1}),
+        _collection("event").find_one({"_id": event_id}, {"_id": 1}),
+    )
+    if not contact:
         raise HTTPException(404, "Contact not found")
-    if not _collection("event").find_one({"_id": event_id}):
+    if not event:
         raise HTTPException(404, "Event not found")
 
-    r = _collection("rsvp").find_one({"contact_id": payload.contact_id, "event_id": payload.event_id})
-    if r:
-        _collection("rsvp").update_one({"_id": r["_id"]}, {"$set": {"status": payload.status, "updated_at": datetime.now(timezone.utc)}})
-        rsvp_id = str(r["_id"])
-    else:
-        rsvp = Rsvp(contact_id=payload.contact_id, event_id=payload.event_id, status=payload.status)
-        rsvp_id = create_document("rsvp", rsvp)
-    return {"id": rsvp_id, "status": payload.status}
+    rsvp = Rsvp(contact_id=payload.contact_id, event_id=payload.event_id, status=payload.status)
+    now = datetime.now(UTC)
+    on_insert = rsvp.model_dump(exclude={"contact_id", "event_id", "status"})
+    on_insert["created_at"] = now
+    r = await _collection("rsvp").find_one_and_update(
+        {"contact_id": payload.contact_id, "event_id": payload.event_id},
+        {"$set": {"status": rsvp.status, "updated_at": now}, "$setOnInsert": on_insert},
+        projection={"_id": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    return {"id": str(r["_id"]), "status": payload.status}
 
 
 @app.post("/sms/webhook")
@@ -275,10 +478,11 @@ async def sms_status_webhook(request: Request):
     if not message_sid:
         return {"ok": True}
 
-    _collection("smsmessage").update_one(
+    now = datetime.now(UTC)
+    await _collection("smsmessage").update_one(
         {"provider_message_sid": message_sid},
-        {"$set": {"status": message_status, "updated_at": datetime.now(timezone.utc)},
-         "$push": {"logs": {"status": message_status, "at": datetime.now(timezone.utc), "to": to, "error_code": error_code}}},
+        {"$set": {"status": message_status, "updated_at": now},
+         "$push": {"logs": {"$each": [{"status": message_status, "at": now, "to": to, "error_code": error_code}], "$slice": -SMS_LOG_HISTORY}}},
         upsert=True,
     )
     return {"ok": True}
@@ -1,9 +1,15 @@
 from datetime import datetime
 from typing import Optional, Literal, List
-from pydantic import BaseModel, Field, EmailStr
+from pydantic import BaseModel, ConfigDict, Field, EmailStr
+
+# Shared by all collection models: drop unknown keys, trim strings, immutable once built
+_MODEL_CONFIG = ConfigDict(extra="ignore", str_strip_whitespace=True, frozen=True)
+
 
 # Contact collection
 class Contact(BaseModel):
+    model_config = _MODEL_CONFIG
+
     name: str = Field(..., description="Full name")
     phone: str = Field(..., description="E.164 phone number, e.g., +15551234567")
     email: Optional[EmailStr] = Field(None, description="Email address")
@@ -22,6 +28,8 @@ class Contact(BaseModel):
 
 # Event collection
 class Event(BaseModel):
+    model_config = _MODEL_CONFIG
+
     name: str
     date: datetime
     type: Literal["club", "after", "special", "private"] = "club"
@@ -33,6 +41,8 @@ class Event(BaseModel):
 
 # RSVP collection
 class Rsvp(BaseModel):
+    model_config = _MODEL_CONFIG
+
     contact_id: str = Field(..., description="ID of contact")
     event_id: str = Field(..., description="ID of event")
     status: Literal["yes", "not_this_time", "no_response"] = "no_response"
@@ -42,6 +52,8 @@ class Rsvp(BaseModel):
 
 # SMS message log collection
 class Smsmessage(BaseModel):  # collection name: smsmessage
+    model_config = _MODEL_CONFIG
+
     to: str
     body: str
     purpose: Literal["verify", "invite", "reminder", "gate_code"]